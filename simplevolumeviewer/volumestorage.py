@@ -1,3 +1,9 @@
+import collections
+import concurrent.futures
+import functools
+import importlib.util
+import os
+
 import numpy as np
 
 class DataTypeError(Exception):
@@ -18,6 +24,9 @@ class IndexLimitsNameError(Exception):
 class SpacingValueError(Exception):
     pass
 
+class BackendError(Exception):
+    pass
+
 
 class VolumeStorage:
 
@@ -58,37 +67,47 @@ class VolumeStorage:
                                  [0, -1.,  1., 0.],
                                  [0,  1.,  0., 0.]
                                 ])
+        
+        modelMatrices = {
+            'L':             linearMatrix,
+            'linear':        linearMatrix,
+            'A':             approxMatrix,
+            'approximation': approxMatrix,
+            'I':             interpMatrix,
+            'interpolation': interpMatrix
+        }
 
         @staticmethod
         def prepareInterpolation(baseNumb, scaleCoef):
 
-            X = np.arange(baseNumb)
             Y = np.arange(int(baseNumb * scaleCoef)) / scaleCoef
             Y = Y[Y <= baseNumb - 1]
             d = baseNumb - 1 - Y[-1]
             Y += d / 2
 
             # indices
-            ind = np.zeros((Y.shape[0], 4))
-
-            ind[:, 1] = Y.astype('int')
-            ind[:, 0] = ind[:, 1] - 1
-            ind[:, 2] = ind[:, 1] + 1
-            ind[:, 3] = ind[:, 1] + 2
-
-            ind = np.clip(ind, 0, baseNumb - 1).astype('int')
+            base = Y.astype(np.int32)
+            
+            ind = base[:, None] + np.arange(-1, 3, dtype = np.int32)
+            np.clip(ind, 0, baseNumb - 1, out = ind)
 
             # interpolation parameters
-            T = np.zeros((Y.shape[0], 4))
-
-            T[:, 3] = 1.
-            T[:, 2] = Y - ind[:, 1]
-            T[:, 1] = T[:, 2] ** 2
-            T[:, 0] = T[:, 2] ** 3
+            t = Y - base
+            
+            T = np.stack([t ** 3, t ** 2, t, np.ones_like(t)], axis = 1)
 
             return ind.reshape(-1), T
 
-        def __init__(self, vSize, vSpacing, hSize, hSpacing):
+        @staticmethod
+        def interpolate(ind, M, img):
+            
+            # weighted sum of four neighbour rows as a single contraction without intermediate 
+            # products (optimize is not used: it is slower here for integer images)
+            I = img[ind].reshape(-1, 4, img.shape[1])
+            
+            return np.einsum('nk,nkw->nw', M, I)
+
+        def __init__(self, vSize, vSpacing, hSize, hSpacing, backend = 'numpy'):
 
             if vSpacing > hSpacing:
 
@@ -100,35 +119,78 @@ class VolumeStorage:
                 self.horizontalScale = True
                 self.ind, self.T = VolumeStorage.Interpolator.prepareInterpolation(hSize, hSpacing / vSpacing)
                 
-        def processImage(self, img, interpModel):
+            # T @ matrix products, computed once per interpolation model and data type on first use
+            self.matrixCache = {}
             
-            if self.horizontalScale:
-                I = img.T[self.ind]
+            # backend: for 'gpu' images are uploaded to GPU and interpolated there (numpy calls 
+            # are dispatched to CuPy for its arrays), the results are returned as numpy arrays
+            if backend == 'gpu':
+                import cupy
+                
+                self.toDevice, self.toHost = cupy.asarray, cupy.asnumpy
                 
             else:
-                I = img[self.ind]
+                self.toDevice = self.toHost = np.asarray
                 
-            I = I.reshape(-1, 4, I.shape[1])
+            self.ind = self.toDevice(self.ind)
                 
-            if interpModel == 'L' or interpModel == 'linear':
-                M = self.T @ VolumeStorage.Interpolator.linearMatrix
+        def processImage(self, img, interpModel):
+            
+            img = self.toDevice(img)
+            
+            # images of 8/16-bit integers or float32 are processed in float32, others in float64
+            dtype = np.result_type(img.dtype, np.float32)
+            
+            M = self.matrixCache.get((interpModel, dtype))
+            
+            if M is None:
+                M = self.toDevice((self.T @ VolumeStorage.Interpolator.modelMatrices[interpModel]).astype(dtype))
+                self.matrixCache[(interpModel, dtype)] = M
                 
-            elif interpModel == 'A' or interpModel == 'approximation':
-                M = self.T @ VolumeStorage.Interpolator.approxMatrix
+            if self.horizontalScale:
+                result = VolumeStorage.Interpolator.interpolate(self.ind, M, img.T).T
                 
-            elif interpModel == 'I' or interpModel == 'interpolation':
-                M = self.T @ VolumeStorage.Interpolator.interpMatrix
+            else:
+                result = VolumeStorage.Interpolator.interpolate(self.ind, M, img)
                 
-            result = np.sum((M.reshape(-1) * I.reshape(-1, I.shape[2]).T).T.reshape(-1, 4, I.shape[2]), 1)
-            
-            if self.horizontalScale:
-                result = result.T
+            # 8/16-bit integer images (CT, MR, PET data) keep their data type as non-interpolated ones; 
+            # spline overshoots are clipped to the type limits
+            if np.issubdtype(img.dtype, np.integer) and dtype == np.float32:
+                limits = np.iinfo(img.dtype)
+                
+                np.rint(result, out = result)
+                np.clip(result, limits.min, limits.max, out = result)
+                
+                result = result.astype(img.dtype)
             
-            return result
+            return self.toHost(result)
             
     
     class VolumeView:
         
+        sliceCacheSize = 8
+        
+        copyTileSize = 16
+        
+        @staticmethod
+        def copyImage(img):
+            
+            rowStride, columnStride = abs(img.strides[0]), abs(img.strides[1])
+            
+            if columnStride <= rowStride or columnStride % 512:
+                return img.copy()
+            
+            # transposed image with power-of-two-like stride: a naive copy reads it across 
+            # the aliased cache lines and thrashes the cache, so the image is copied by 
+            # narrow column strips with contiguous reading inside
+            result = np.empty(img.shape, img.dtype)
+            tile = VolumeStorage.VolumeView.copyTileSize
+            
+            for j in range(0, img.shape[1], tile):
+                result[:, j:j + tile] = img[:, j:j + tile]
+                
+            return result
+        
         def __init__(self, storage, viewDirection, upDirection, verticalFlip = True, interpModel = 'none'):
             
             if not (viewDirection in VolumeStorage.StandartAxisNames.keys() and 
@@ -153,14 +215,12 @@ class VolumeStorage:
             self.storage = storage
             
             # AXES
-            self.viewAxisIndex  = np.argmax(np.abs(np.sum(self.storage.axes * self.viewDirection, 1)))
-            self.upAxisIndex    = np.argmax(np.abs(np.sum(self.storage.axes * self.upDirection, 1)))
-            self.rightAxisIndex = [i for i in range(3) if not i in [self.viewAxisIndex, self.upAxisIndex]][0]
+            self.viewAxisIndex  = int(np.abs(self.storage.axes @ self.viewDirection).argmax())
+            self.upAxisIndex    = int(np.abs(self.storage.axes @ self.upDirection).argmax())
+            self.rightAxisIndex = 3 - self.viewAxisIndex - self.upAxisIndex
             
             self.rightDirection = np.cross(self.viewDirection, self.upDirection)
                 
-            self.tranposeFlag = self.upAxisIndex > self.rightAxisIndex
-                
             if self.verticalFlip:
                 self.upDirection = -self.upDirection
                 
@@ -168,6 +228,12 @@ class VolumeStorage:
             hStep = -1 if np.sum(self.rightDirection * self.storage.axes[self.rightAxisIndex]) < 0 else 1
                 
             self.slice = np.s_[::vStep, ::hStep]
+            
+            # data view with (view, up, right) axes order and flipped image axes: slices are 
+            # extracted already oriented, so the images don't need to be transformed for each call
+            self.viewData = self.storage.data.transpose(self.viewAxisIndex, 
+                                                        self.upAxisIndex, 
+                                                        self.rightAxisIndex)[(slice(None),) + self.slice]
 
             self.viewName = viewDirection
             self.upName = upDirection
@@ -187,28 +253,38 @@ class VolumeStorage:
             # interpolation
             if not vSpacing == hSpacing:
                 self.interpoalateFlag = True
-                self.interpoalator = VolumeStorage.Interpolator(vSize = vSize, 
-                                                                vSpacing = vSpacing, 
-                                                                hSize = hSize, 
-                                                                hSpacing = hSpacing)
+                self.interpoalator = self.storage.getInterpolator(vSize = vSize, 
+                                                                  vSpacing = vSpacing, 
+                                                                  hSize = hSize, 
+                                                                  hSpacing = hSpacing)
             else:
                 self.interpoalateFlag = False
                 
             self.interpModel = interpModel
+            self.transformImage = self.pickTransform()
+            
+            # CACHE
+            self.sliceCache = collections.OrderedDict()
+            self.mipImage = None
                 
         def setInterpolationModel(self, interpModel):
             self.interpModel = interpModel
+            self.transformImage = self.pickTransform()
+            
+            self.sliceCache.clear()
+            self.mipImage = None
             
         def getInterpolationModel(self):
             return self.interpModel
             
-        def transformImage(self, img):
+        def pickTransform(self):
+            # the image transform is fixed until the interpolation model is changed, so it is 
+            # selected once and bound as transformImage instead of branching for each image
             if self.interpoalateFlag and not self.interpModel == 'none':
-                return self.interpoalator.processImage((img.T if self.tranposeFlag else img)[self.slice], 
-                                                        self.interpModel) 
+                return functools.partial(self.interpoalator.processImage, interpModel = self.interpModel)
                 
             else:
-                return (img.T if self.tranposeFlag else img)[self.slice].copy() 
+                return VolumeStorage.VolumeView.copyImage
             
         def getIndexLimits(self):
             return self.minIndex, self.maxIndex
@@ -255,7 +331,19 @@ class VolumeStorage:
                                           "axis #" + str(self.viewAxisIndex) + " (" + str(self.minIndex) +
                                           " >= ind <=" + str(self.maxIndex) + ").")
                 
-            return self.transformImage(self.storage.data.take(indices = ind, axis = self.viewAxisIndex))
+            if ind in self.sliceCache:
+                self.sliceCache.move_to_end(ind)
+                return self.sliceCache[ind]
+            
+            # basic indexing returns a view, the image is copied by transformImage only
+            img = self.transformImage(self.viewData[ind])
+            img.flags.writeable = False
+            
+            self.sliceCache[ind] = img
+            if len(self.sliceCache) > VolumeStorage.VolumeView.sliceCacheSize:
+                self.sliceCache.popitem(last = False)
+                
+            return img
         
         def getCurrentSlice(self):
             return self.getSlice(self.currentIndex)
@@ -269,11 +357,48 @@ class VolumeStorage:
             return self.getSlice(self.currentIndex)
         
         def getMIP(self):
-            return self.transformImage(np.max(self.storage.data, self.viewAxisIndex))
+            if self.mipImage is None:
+                # MIP axes follow the storage data order: (up, right) or (right, up)
+                mip = self.storage.getMIP(self.viewAxisIndex)
+                
+                mip = mip if self.upAxisIndex < self.rightAxisIndex else mip.T
+                
+                self.mipImage = self.transformImage(mip[self.slice])
+                self.mipImage.flags.writeable = False
+                
+            return self.mipImage
             
     
+    threadsNumber = os.cpu_count() or 1
+    
+    @staticmethod
+    def maxProjection(data, axis):
+        
+        # the volume is split into slabs along the outer non-reduced axis (the first MIP axis);
+        # numpy releases the GIL inside the reduction, so the slabs are reduced in parallel threads
+        splitAxis = 1 if axis == 0 else 0
+        
+        threadsNumber = min(VolumeStorage.threadsNumber, data.shape[splitAxis])
+        
+        if threadsNumber < 2:
+            return np.max(data, axis)
+        
+        mip = np.empty(data.shape[:axis] + data.shape[axis + 1:], data.dtype)
+        bounds = np.linspace(0, data.shape[splitAxis], threadsNumber + 1).astype(int)
+        
+        def reduceSlab(start, stop):
+            slab = [slice(None)] * 3
+            slab[splitAxis] = slice(start, stop)
+            
+            np.max(data[tuple(slab)], axis, out = mip[start:stop])
+            
+        with concurrent.futures.ThreadPoolExecutor(threadsNumber) as executor:
+            list(executor.map(reduceSlab, bounds[:-1], bounds[1:]))
+            
+        return mip
+    
     def __init__(self, data, directions = 'left-posterior-superior', spacing = np.ones((3)),
-                 initStandarView = True, verticalFlip = True, interpModel = 'none'):
+                 initStandarView = True, verticalFlip = True, interpModel = 'none', backend = 'numpy'):
         
         # DATA
         if not type(data) == np.ndarray:
@@ -287,26 +412,24 @@ class VolumeStorage:
         if data.size == 0:
             raise SpacingValueError("Volume data should be not empty.")
             
-        self.data = data.copy()
+        # the volume is shared with the caller (not copied) and locked for writing,
+        # so the passed array should not be modified after the storage creation
+        self.data = np.ascontiguousarray(data).view()
+        self.data.flags.writeable = False
         
         # AXES
         dirNames = directions.lower().split('-')
         
         if len(dirNames) == 3:
             
-            self.axes = np.zeros((3, 3))
-            axisNamesSet = set()
-            
-            for i in range(3):
-                if not dirNames[i] in VolumeStorage.StandartAxisNames.keys():
-                    raise DirectionsNameError("The valid direction names are \'left\' or \'right\' " + 
-                                              "(for frontal axis), \'superior\' or \'inferior\' " + 
-                                              "(for saggital axis) and \'posterior\' or \'anterior\' " + 
-                                              "(for vertical axis) only. Ex.: \'left-posterior-superior\'.")
-                
-                self.axes[i] = VolumeStorage.StandartAxisDirections[dirNames[i]]
-                axisNamesSet.add(VolumeStorage.StandartAxisNames[dirNames[i]])
+            if set(dirNames) - VolumeStorage.StandartAxisNames.keys():
+                raise DirectionsNameError("The valid direction names are \'left\' or \'right\' " + 
+                                          "(for frontal axis), \'superior\' or \'inferior\' " + 
+                                          "(for saggital axis) and \'posterior\' or \'anterior\' " + 
+                                          "(for vertical axis) only. Ex.: \'left-posterior-superior\'.")
                 
+            self.axes = np.stack([VolumeStorage.StandartAxisDirections[name] for name in dirNames])
+            axisNamesSet = {VolumeStorage.StandartAxisNames[name] for name in dirNames}
                 
             if not len(axisNamesSet) == 3:
                 raise DirectionsNameError("Expected directions along three axes: " +
@@ -336,7 +459,24 @@ class VolumeStorage:
         if np.min(spacing) <= 0:
             raise DataTypeError("Spacing value should be positive number.")
             
-        self.spacing = spacing.copy()
+        # immutable and hashable: views with the same image geometry share interpolators
+        self.spacing = tuple(float(s) for s in spacing)
+        
+        # BACKEND
+        if not backend in ['numpy', 'gpu']:
+            raise BackendError("The valid backend names are \'numpy\' or \'gpu\' only, but \'" + 
+                               str(backend) + "\' was detected.")
+            
+        if backend == 'gpu' and importlib.util.find_spec('cupy') is None:
+            raise BackendError("The \'gpu\' backend requires cupy package.")
+            
+        self.backend = backend
+        
+        # MIP (shared by the views with the same view axis)
+        self.mipByAxis = {}
+        
+        # INTERPOLATORS (shared by the views with the same image sizes and spacing)
+        self.interpolators = {}
         
         # VIEWS
         self.views = {}
@@ -371,3 +511,22 @@ class VolumeStorage:
                                                     upDirection = upDirection, 
                                                     verticalFlip = verticalFlip,
                                                     interpModel = interpModel)
+        
+    def getMIP(self, axis):
+        if not axis in self.mipByAxis:
+            self.mipByAxis[axis] = VolumeStorage.maxProjection(self.data, axis)
+            self.mipByAxis[axis].flags.writeable = False
+            
+        return self.mipByAxis[axis]
+    
+    def getInterpolator(self, vSize, vSpacing, hSize, hSpacing):
+        key = (vSize, vSpacing, hSize, hSpacing)
+        
+        if not key in self.interpolators:
+            self.interpolators[key] = VolumeStorage.Interpolator(vSize = vSize, 
+                                                                 vSpacing = vSpacing, 
+                                                                 hSize = hSize, 
+                                                                 hSpacing = hSpacing,
+                                                                 backend = self.backend)
+            
+        return self.interpolators[key]